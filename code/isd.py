@@ -3,11 +3,23 @@ import torch.nn as nn
 import torch.nn.functional as F
 import copy
 
+
+def kl_div_with_temperature(inputs, targets, T):
+    """KL(softmax(targets / T) || softmax(inputs / T)), batchmean; written so
+    torch.compile can fuse it into a single kernel"""
+    # softmax over the queue needs fp32 even when the similarities come from autocast
+    log_p = F.log_softmax(inputs.float() / T, dim=1)
+    log_t = F.log_softmax(targets.float() / T, dim=1)
+    return (log_t.exp() * (log_t - log_p)).sum(dim=1).mean()
+
+
 class KLD(nn.Module):
+    def __init__(self, T):
+        super(KLD, self).__init__()
+        self.T = T
+
     def forward(self, inputs, targets):
-        inputs = F.log_softmax(inputs, dim=1)
-        targets = F.softmax(targets, dim=1)
-        return F.kl_div(inputs, targets, reduction='batchmean')
+        return kl_div_with_temperature(inputs, targets, self.T)
 
 
 def get_mlp(inp_dim, hidden_dim, out_dim):
@@ -19,22 +31,13 @@ def get_mlp(inp_dim, hidden_dim, out_dim):
     )
     return mlp
 
-def get_shuffle_ids(bsz):
-    """generate shuffle ids for ShuffleBN"""
-    forward_inds = torch.randperm(bsz).long().cuda()
-    backward_inds = torch.zeros(bsz).long().cuda()
-    value = torch.arange(bsz).long().cuda()
-    backward_inds.index_copy_(0, forward_inds, value)
-    return forward_inds, backward_inds
-
 
 class ISD(nn.Module):
-    def __init__(self, arch, K=65536, m=0.999, T=0.07):
+    def __init__(self, arch, K=65536, m=0.999, queue_dtype=torch.float32):
         super(ISD, self).__init__()
 
         self.K = K
         self.m = m
-        self.T = T
 
         # create encoders and projection layers        
         self.encoder_q = copy.deepcopy(arch)
@@ -54,35 +57,37 @@ class ISD(nn.Module):
         for param_q, param_k in zip(self.encoder_q.parameters(), self.encoder_k.parameters()):
             param_k.data.copy_(param_q.data)
             param_k.requires_grad = False
+
+        # cached for the multi-tensor momentum update, .to() and wrappers keep the same Parameters
+        self._q_params = list(self.encoder_q.parameters())
+        self._k_params = list(self.encoder_k.parameters())
         
-        # setup queue
-        self.register_buffer('queue', torch.randn(self.K, out_dim))
-        # normalize the queue
-        self.queue = nn.functional.normalize(self.queue, dim=0)
+        # setup queue, stored as [out_dim, K] so it can be used in matmuls as is;
+        # mixed precision training passes bfloat16 to halve the bytes read by the
+        # similarity matmul; fp16 would underflow the ~1e-5 gradients on sim
+        # without a GradScaler, bf16 keeps the fp32 exponent range
+        queue = nn.functional.normalize(torch.randn(out_dim, self.K), dim=0)
+        self.register_buffer('queue', queue.to(queue_dtype))
 
         # setup the queue pointer
         self.register_buffer('queue_ptr', torch.zeros(1, dtype=torch.long))
         
     @torch.no_grad()
     def _momentum_update_key_encoder(self):
-        for param_q, param_k in zip(self.encoder_q.parameters(), self.encoder_k.parameters()):
-            param_k.data = param_k.data * self.m + param_q.data * (1. - self.m)
+        torch._foreach_mul_(self._k_params, self.m)
+        torch._foreach_add_(self._k_params, self._q_params, alpha=1. - self.m)
             
     @torch.no_grad()
-    def data_parallel(self):
-        self.encoder_q = torch.nn.DataParallel(self.encoder_q)
-        self.encoder_k = torch.nn.DataParallel(self.encoder_k)
-        self.predict_q = torch.nn.DataParallel(self.predict_q)
-        
-    @torch.no_grad()
-    def _dequeue_and_enqueue(self, keys):
+    def dequeue_and_enqueue(self, keys):
+        """call after loss.backward(): the similarity matmul saves the queue
+        for backward, so writing it earlier fails autograd's version check"""
         batch_size = keys.shape[0]
 
         ptr = int(self.queue_ptr)
         assert self.K % batch_size == 0 
 
         # replace the keys at ptr (dequeue and enqueue)
-        self.queue[ptr:ptr + batch_size] = keys
+        self.queue[:, ptr:ptr + batch_size] = keys.t()
         ptr = (ptr + batch_size) % self.K  # move pointer
 
         self.queue_ptr[0] = ptr
@@ -91,32 +96,24 @@ class ISD(nn.Module):
         res, feat_q = self.encoder_q(im_q)
         q = self.predict_q(feat_q)
         q = nn.functional.normalize(q, dim=1)
-        # compute key features
-        with torch.no_grad():
+        # compute key features under inference mode: k only feeds cat, which saves
+        # nothing for backward, and dequeue_and_enqueue, which runs after backward
+        with torch.inference_mode():
             # update the key encoder
             self._momentum_update_key_encoder()
 
-            # shuffle keys
-            shuffle_ids, reverse_ids = get_shuffle_ids(im_k.shape[0])
-            im_k = im_k[shuffle_ids]
-
             # forward through the key encoder
             _, k = self.encoder_k(im_k)
             k = nn.functional.normalize(k, dim=1)
-
-            # undo shuffle
-            k = k[reverse_ids]
             
-        # calculate similarities
-        queue = self.queue.clone().detach()
-        sim_q = torch.mm(q, queue.t())
-        sim_k = torch.mm(k, queue.t())
-
-        # scale the similarities with temperature
-        sim_q /= self.T
-        sim_k /= self.T
-
-        # dequeue and enqueue
-        self._dequeue_and_enqueue(k)
-
-        return res, sim_q, sim_k
\ No newline at end of file
+        # calculate similarities for q and k with a single matmul, no clone of the
+        # queue is needed since it is only written after backward
+        batch_size = q.shape[0]
+        # run the matmul in the queue's dtype, so --no-amp keeps it in fp32
+        with torch.autocast('cuda', enabled=False):
+            qk = torch.cat([q, k], dim=0).to(self.queue.dtype)
+            sim = torch.mm(qk, self.queue)
+        sim_q, sim_k = sim[:batch_size], sim[batch_size:]
+
+        # k is returned for dequeue_and_enqueue once backward has run
+        return res, sim_q, sim_k, k
\ No newline at end of file
@@ -15,6 +15,7 @@ import random
 import numpy as np
 import torchvision
 import torchvision.transforms as transforms
+from torchvision.transforms import v2
 from torch.utils.data import sampler
 import torch.optim as optim
 from tensorboardX import SummaryWriter
@@ -110,25 +111,30 @@ def prepare_dataloaders():
     std = [0.2023, 0.1994, 0.2010]
     normalize = transforms.Normalize(mean=mean, std=std)
     
-    aug_strong = transforms.Compose([
-        transforms.RandomResizedCrop(image_size, scale=(0.2, 1.)),
-        transforms.RandomApply([
-            transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)  # not strengthened
+    # v2 transforms work on uint8 tensors, so convert once up front and skip PIL
+    aug_strong = v2.Compose([
+        v2.ToImage(),
+        v2.ToDtype(torch.uint8, scale=False),
+        v2.RandomResizedCrop(image_size, scale=(0.2, 1.), antialias=True),
+        v2.RandomApply([
+            v2.ColorJitter(0.4, 0.4, 0.4, 0.1)  # not strengthened
         ], p=0.8),
-        transforms.RandomGrayscale(p=0.2),
-        transforms.RandomApply(torch.nn.ModuleList([
-            transforms.GaussianBlur(kernel_size=(3, 3), sigma=(0.1, 2))
-            ]), p=0.3), 
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        normalize
+        v2.RandomGrayscale(p=0.2),
+        v2.RandomApply([
+            v2.GaussianBlur(kernel_size=(3, 3), sigma=(0.1, 2))
+            ], p=0.3), 
+        v2.RandomHorizontalFlip(),
+        v2.ToDtype(torch.float32, scale=True),
+        v2.Normalize(mean=mean, std=std)
     ])
 
-    aug_weak = transforms.Compose([
-        transforms.RandomResizedCrop(image_size, scale=(0.2, 1.)),
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        normalize
+    aug_weak = v2.Compose([
+        v2.ToImage(),
+        v2.ToDtype(torch.uint8, scale=False),
+        v2.RandomResizedCrop(image_size, scale=(0.2, 1.), antialias=True),
+        v2.RandomHorizontalFlip(),
+        v2.ToDtype(torch.float32, scale=True),
+        v2.Normalize(mean=mean, std=std)
     ])
     
 
@@ -219,7 +225,7 @@ def prepare_dataloaders():
 
 def train(model, train_loader, val_loader, optimizer, criterion):
     ## self-supervised loss: kld
-    kld = KLD().to(DEVICE)
+    kld = KLD(T=args.T).to(DEVICE)
     ## create strong transform for teacher
     # transform_strong = transforms.Compose([
     #     transforms.RandomApply([
@@ -252,7 +258,7 @@ def train(model, train_loader, val_loader, optimizer, criterion):
             
             optimizer.zero_grad()
 
-            outputs, sim_q, sim_k = model(im_q, im_k)
+            outputs, sim_q, sim_k, k = model(im_q, im_k)
 
             loss_isd = kld(inputs=sim_q, targets=sim_k)
             
@@ -260,6 +266,9 @@ def train(model, train_loader, val_loader, optimizer, criterion):
             loss.backward()
             optimizer.step()
 
+            # the queue is saved for backward, so only update it now
+            model.dequeue_and_enqueue(k)
+
             acc = accuracy(outputs=outputs, labels=labels)
             total_train_loss += loss.item()
             total_train_acc += acc
@@ -363,7 +372,7 @@ def main():
                          num_planes=[64, 128, 256, 512],
                          num_blocks=[2, 1, 1, 1])
     model = model.to(DEVICE)
-    isd = ISD(model, K=args.K, m=args.m, T=args.T).to(DEVICE)
+    isd = ISD(model, K=args.K, m=args.m).to(DEVICE)
 
     num_trainable_params = count_parameters(model)
     print('The num of total trainable parameter in our model is', num_trainable_params)
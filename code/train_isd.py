@@ -6,11 +6,18 @@ Reference:
     ISD: Self-Supervised Learning by Iterative Similarity Distillation
 """
 
+import os
+# must be set before the first cuda allocation; grows segments in place
+# instead of fragmenting on the large queue and similarity buffers
+os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+
 import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
 import random
 import numpy as np
 import torchvision
@@ -18,13 +25,12 @@ import torchvision.transforms as transforms
 from torch.utils.data import sampler
 import torch.optim as optim
 from tensorboardX import SummaryWriter
+import kornia.augmentation as K
 
-import os
+import time
 import argparse
 from tqdm import tqdm
 
-from PIL import ImageFilter
-
 from utils import *
 from model import *
 from isd import *
@@ -45,6 +51,8 @@ def parse_option():
                         help='save_path')
     parser.add_argument('--save_every_e', type=int, default=10,
                         help='save model per save_every_e epoch')
+    parser.add_argument('--print_freq', type=int, default=50,
+                        help='measure batch time every print_freq steps')
     parser.add_argument('--batch_size', type=int, default=128,
                         help='batch_size per gpu')
     parser.add_argument('--max_epoch', type=int, default=100,
@@ -54,6 +62,8 @@ def parse_option():
                         1: num_planes=[32,64,128,256], num_blocks=[2,2,2,2]')
     parser.add_argument('--learning_rate', type=float, default=0.01,
                         help='initial learning rate')
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='dataloader workers, -1 picks 0 for the in-memory train set')
 
     parser.add_argument('--l2_reg', default=False, action='store_true')
     parser.add_argument('--no-l2_reg', dest='l2_reg', action='store_false')
@@ -61,6 +71,15 @@ def parse_option():
                         help='whether to cosine learning rate or not')
     parser.add_argument('--adjust_lr', default=False, action='store_true')
     parser.add_argument('--no-adjust_lr', dest='adjust_lr', action='store_false')
+    parser.add_argument('--amp', default=True, action='store_true',
+                        help='run forward and loss under bf16 autocast with a bf16 queue')
+    parser.add_argument('--no-amp', dest='amp', action='store_false')
+    parser.add_argument('--compile', default=True, action='store_true',
+                        help='torch.compile the encoders and prediction head')
+    parser.add_argument('--no-compile', dest='compile', action='store_false')
+    parser.add_argument('--syncbn', default=True, action='store_true',
+                        help='use SyncBatchNorm in encoder_k under DDP')
+    parser.add_argument('--no-syncbn', dest='syncbn', action='store_false')
 
     parser.add_argument('--checkpoint_path', default='./model', type=str,
                         help='where to save checkpoints.')
@@ -78,87 +97,255 @@ def parse_option():
     parser.add_argument('--augmentation', type=str, default='weak/strong',
                         choices=['weak/strong', 'weak/weak', 'strong/weak', 'strong/strong'],
                         help='augmentation combo')
+    parser.add_argument('--loader', type=str, default='torch',
+                        choices=['torch', 'dali'],
+                        help='torch: DataLoader + kornia gpu augmentation; dali: NVIDIA DALI gpu pipeline')
 
 
     args = parser.parse_args()
 
     return args
 
-# Create train loader
-def get_train_loader(args):
+class GPUTwoCropAug(nn.Module):
+    """batched two-crop augmentation applied on the GPU with kornia"""
+    def __init__(self, k_t, q_t):
+        super(GPUTwoCropAug, self).__init__()
+        self.q_t = q_t
+        self.k_t = k_t
+        print('======= Query transform =======')
+        print(self.q_t)
+        print('===============================')
+        print('======== Key transform ========')
+        print(self.k_t)
+        print('===============================')
+
+    @torch.no_grad()
+    def forward(self, x):
+        # uint8 batch straight from the loader
+        x = x.float().div_(255.)
+        q = self.q_t(x)
+        k = self.k_t(x)
+        return q, k
+
+
+# Create GPU augmentation
+def get_train_aug(args):
     image_size = 32
-    mean = [0.4914, 0.4822, 0.4465]
-    std = [0.2023, 0.1994, 0.2010]
-    normalize = transforms.Normalize(mean=mean, std=std)
-
-    aug_strong = transforms.Compose([
-        transforms.RandomResizedCrop(image_size, scale=(0.2, 1.)),
-        transforms.RandomApply([
-            transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)  # not strengthened
-        ], p=0.8),
-        transforms.RandomGrayscale(p=0.2),
-        transforms.RandomApply(torch.nn.ModuleList([
-            transforms.GaussianBlur(kernel_size=(3, 3), sigma=(0.1, 2))
-        ]), p=0.3),
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        normalize
-    ])
-
-    aug_weak = transforms.Compose([
-        transforms.RandomResizedCrop(image_size, scale=(0.2, 1.)),
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        normalize
-    ])
+    mean = torch.tensor([0.4914, 0.4822, 0.4465])
+    std = torch.tensor([0.2023, 0.1994, 0.2010])
+
+    # kornia color ops expect inputs in [0, 1], so normalize last
+    aug_strong = nn.Sequential(
+        K.RandomResizedCrop((image_size, image_size), scale=(0.2, 1.)),
+        K.ColorJitter(0.4, 0.4, 0.4, 0.1, p=0.8),  # not strengthened
+        K.RandomGrayscale(p=0.2),
+        K.RandomGaussianBlur((3, 3), (0.1, 2.0), p=0.3),
+        K.RandomHorizontalFlip(),
+        K.Normalize(mean=mean, std=std)
+    )
+
+    aug_weak = nn.Sequential(
+        K.RandomResizedCrop((image_size, image_size), scale=(0.2, 1.)),
+        K.RandomHorizontalFlip(),
+        K.Normalize(mean=mean, std=std)
+    )
 
     if args.augmentation == 'weak/strong':
-        train_dataset = torchvision.datasets.CIFAR10(
-            root=args.root_path,
-            train=True,
-            download=True,
-            transform=TwoCropsTransform(k_t=aug_weak, q_t=aug_strong)
-        )
+        aug = GPUTwoCropAug(k_t=aug_weak, q_t=aug_strong)
     elif args.augmentation == 'weak/weak':
-        train_dataset = torchvision.datasets.CIFAR10(
-            root=args.root_path,
-            train=True,
-            download=True,
-            transform=TwoCropsTransform(k_t=aug_weak, q_t=aug_weak)
-        )
+        aug = GPUTwoCropAug(k_t=aug_weak, q_t=aug_weak)
     elif args.augmentation == 'strong/weak':
-        train_dataset = torchvision.datasets.CIFAR10(
-            root=args.root_path,
-            train=True,
-            download=True,
-            transform=TwoCropsTransform(k_t=aug_strong, q_t=aug_weak)
-        )
+        aug = GPUTwoCropAug(k_t=aug_strong, q_t=aug_weak)
     else: # strong/strong
-        train_dataset = torchvision.datasets.CIFAR10(
-            root=args.root_path,
-            train=True,
-            download=True,
-            transform=TwoCropsTransform(k_t=aug_strong, q_t=aug_strong)
-        )
+        aug = GPUTwoCropAug(k_t=aug_strong, q_t=aug_strong)
 
+    return aug.to(DEVICE)
+
+
+class CIFARTensorDataset(torch.utils.data.Dataset):
+    """CIFAR-10 held in memory as a single uint8 tensor of shape [N, 3, 32, 32]"""
+    def __init__(self, images, labels):
+        self.images = images
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, idx):
+        # idx may be a whole batch of indices, see get_train_loader
+        return self.images[idx], self.labels[idx]
+
+
+# Create train loader
+def get_train_loader(args):
+    # augmentation runs batched on the GPU, see get_train_aug
+    cifar = torchvision.datasets.CIFAR10(
+        root=args.root_path,
+        train=True,
+        download=True
+    )
+    images = torch.from_numpy(cifar.data).permute(0, 3, 1, 2).contiguous()
+    images.share_memory_()
+    labels = torch.tensor(cifar.targets)
+    train_dataset = CIFARTensorDataset(images, labels)
+
+    if args.distributed:
+        train_sampler = torch.utils.data.DistributedSampler(train_dataset)
+    else:
+        train_sampler = torch.utils.data.RandomSampler(train_dataset)
+
+    # sample whole batches so each step is a single slice of the tensor
+    batch_sampler = torch.utils.data.BatchSampler(
+        train_sampler,
+        batch_size=args.batch_size,
+        drop_last=True)
+
+    # a batch is one slice of an in-memory tensor, workers would only add
+    # pickling and shared-memory transfer per batch
+    num_workers = args.num_workers
+    if num_workers < 0:
+        num_workers = 0
+
+    # keep workers alive across epochs, prefetch_factor is capped at 4 to bound memory
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs = dict(persistent_workers=True, prefetch_factor=4)
 
     train_loader = torch.utils.data.DataLoader(
         train_dataset,
-        batch_size=args.batch_size,
-        shuffle=True,
-        num_workers=2,
+        batch_size=None,
+        sampler=batch_sampler,
+        num_workers=num_workers,
         pin_memory=True,
-        drop_last=True)
+        **worker_kwargs)
 
     return train_loader
 
 
+class CIFARSource:
+    """endless shuffled batches of raw CIFAR-10 images for DALI external_source"""
+    def __init__(self, images, batch_size):
+        self.images = images
+        self.batch_size = batch_size
+        self.perm = np.random.permutation(len(images))
+        self.pos = 0
+
+    def __call__(self):
+        if self.pos + self.batch_size > len(self.perm):
+            self.perm = np.random.permutation(len(self.images))
+            self.pos = 0
+        idx = self.perm[self.pos:self.pos + self.batch_size]
+        self.pos += self.batch_size
+        return self.images[idx]
+
+
+# Create DALI train loader
+def get_dali_train_loader(args):
+    from nvidia.dali import pipeline_def, fn, types
+    from nvidia.dali.plugin.pytorch import DALIGenericIterator, LastBatchPolicy
+
+    image_size = 32
+    mean = [0.4914 * 255, 0.4822 * 255, 0.4465 * 255]
+    std = [0.2023 * 255, 0.1994 * 255, 0.2010 * 255]
+
+    def augment(images, strong):
+        images = fn.random_resized_crop(images, size=(image_size, image_size), random_area=(0.2, 1.))
+        if strong:
+            if fn.random.coin_flip(probability=0.8):
+                images = fn.color_twist(images,
+                                        brightness=fn.random.uniform(range=(0.6, 1.4)),
+                                        contrast=fn.random.uniform(range=(0.6, 1.4)),
+                                        saturation=fn.random.uniform(range=(0.6, 1.4)),
+                                        hue=fn.random.uniform(range=(-36., 36.)))  # degrees
+            if fn.random.coin_flip(probability=0.2):
+                images = fn.color_twist(images, saturation=0.)
+            if fn.random.coin_flip(probability=0.3):
+                images = fn.gaussian_blur(images, window_size=3,
+                                          sigma=fn.random.uniform(range=(0.1, 2.)))
+        return fn.crop_mirror_normalize(images,
+                                        dtype=types.FLOAT,
+                                        output_layout='CHW',
+                                        mean=mean,
+                                        std=std,
+                                        mirror=fn.random.coin_flip())
+
+    @pipeline_def(enable_conditionals=True)
+    def two_crop_pipeline(source, q_strong, k_strong):
+        images = fn.external_source(source=source, batch=True, layout='HWC')
+        images = images.gpu()
+        return augment(images, q_strong), augment(images, k_strong)
+
+    train_dataset = torchvision.datasets.CIFAR10(
+        root=args.root_path,
+        train=True,
+        download=True
+    )
+
+    # each process reads its own shard of the train set
+    images = train_dataset.data
+    if args.distributed:
+        images = images[dist.get_rank()::dist.get_world_size()]
+
+    k_aug, q_aug = args.augmentation.split('/')
+    pipe = two_crop_pipeline(source=CIFARSource(images, args.batch_size),
+                             q_strong=(q_aug == 'strong'),
+                             k_strong=(k_aug == 'strong'),
+                             batch_size=args.batch_size,
+                             num_threads=4,
+                             device_id=torch.cuda.current_device(),
+                             prefetch_queue_depth=2)
+    pipe.build()
+
+    # the source never runs dry, size marks the epoch boundary
+    train_loader = DALIGenericIterator(pipe, ['q', 'k'],
+                                       size=len(images),
+                                       auto_reset=True,
+                                       last_batch_policy=LastBatchPolicy.DROP)
+
+    return train_loader
+
+
+@torch.no_grad()
+def snapshot(module):
+    return {k: v.clone() for k, v in module.state_dict().items()}
+
+
+def warmup(args, isd, criterion):
+    """run one throwaway step so the allocator and torch.compile settle before
+    training, then restore the weights, BN stats and queue it touched"""
+    state = snapshot(isd)
+    dummy = torch.zeros(args.batch_size, 3, 32, 32, device=DEVICE)
+    dummy = dummy.contiguous(memory_format=torch.channels_last)
+    isd.train()
+    with torch.autocast('cuda', dtype=torch.bfloat16, enabled=args.amp):
+        _, sim_q, sim_k, k = isd(im_q=dummy, im_k=dummy)
+        loss = criterion(inputs=sim_q, targets=sim_k)
+    loss.backward()
+    isd.dequeue_and_enqueue(k)
+    torch.cuda.synchronize()
+    isd.load_state_dict(state)
+    isd.zero_grad(set_to_none=True)
+
+
 def main():
     args = parse_option()
     os.makedirs(args.checkpoint_path, exist_ok=True)
 
-    # prepare train_loader
-    train_loader = get_train_loader(args)
+    # launched with torchrun: one process per gpu
+    args.distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    args.rank = 0
+    if args.distributed:
+        dist.init_process_group('nccl')
+        args.rank = dist.get_rank()
+        torch.cuda.set_device(int(os.environ['LOCAL_RANK']))
+
+    # prepare train_loader and gpu augmentation
+    if args.loader == 'dali':
+        train_loader = get_dali_train_loader(args)
+        train_aug = None
+    else:
+        train_loader = get_train_loader(args)
+        train_aug = get_train_aug(args)
 
     ## initialize the model
     model = MyResNet()
@@ -175,11 +362,23 @@ def main():
     model.linear = nn.Sequential()
     model = model.to(DEVICE)
 
-    isd = ISD(model, K=args.K, m=args.m, T=args.T).to(DEVICE)
+    # --no-amp keeps the whole similarity path in fp32
+    queue_dtype = torch.bfloat16 if args.amp else torch.float32
+    isd = ISD(model, K=args.K, m=args.m, queue_dtype=queue_dtype)
+    # every DDP process normalizes only its own batch, share the key BN statistics
+    if args.distributed and args.syncbn:
+        isd.encoder_k = nn.SyncBatchNorm.convert_sync_batchnorm(isd.encoder_k)
+    isd = isd.to(DEVICE)
+    # NHWC lets cudnn pick the tensor-core conv kernels
+    isd.encoder_q = isd.encoder_q.to(memory_format=torch.channels_last)
+    isd.encoder_k = isd.encoder_k.to(memory_format=torch.channels_last)
 
-    print(isd)
+    if args.rank == 0:
+        print(isd)
 
-    criterion = KLD().to(DEVICE)
+    criterion = KLD(T=args.T).to(DEVICE)
+    if args.compile:
+        criterion = torch.compile(criterion, fullgraph=True)
 
     params = [p for p in isd.parameters() if p.requires_grad]
     weight_decay = 1e-6 if args.l2_reg else 0
@@ -191,49 +390,107 @@ def main():
 
     args.start_epoch = 1
 
+    # checkpoints hold unwrapped keys, so load before wrapping with DDP
     if args.resume_path:
         print('==> resume from checkpoint: {}'.format(args.resume_path))
-        ckpt = torch.load(args.resume_path)
+        ckpt = torch.load(args.resume_path, map_location=DEVICE)
         print('==> resume from epoch: {}'.format(ckpt['epoch']))
         isd.load_state_dict(ckpt['state_dict'], strict=True)
         optimizer.load_state_dict(ckpt['optimizer'])
         args.start_epoch = ckpt['epoch'] + 1
 
+    # encoder_k has no trainable parameters, it follows encoder_q by momentum
+    if args.distributed:
+        device_id = torch.cuda.current_device()
+        isd.encoder_q = DDP(isd.encoder_q, device_ids=[device_id])
+        isd.predict_q = DDP(isd.predict_q, device_ids=[device_id])
+        # DDP only syncs the wrapped modules, start every rank from rank 0's teacher
+        for t in list(isd.encoder_k.parameters()) + list(isd.encoder_k.buffers()):
+            dist.broadcast(t, src=0)
+
+    # input shapes are fixed (drop_last), so specialize on them
+    if args.compile:
+        isd.encoder_q = torch.compile(isd.encoder_q, mode='max-autotune', dynamic=False)
+        isd.encoder_k = torch.compile(isd.encoder_k, mode='max-autotune', dynamic=False)
+        # lets inductor fuse the head's BN-normalize + ReLU and the bias add into the GEMM epilogues
+        isd.predict_q = torch.compile(isd.predict_q, mode='max-autotune', dynamic=False)
+
+
+    warmup(args, isd, criterion)
 
     # train isd
-    train(args, train_loader, isd, criterion, optimizer)
+    train(args, train_loader, train_aug, isd, criterion, optimizer)
+
+    if args.distributed:
+        dist.destroy_process_group()
+
+def train(args, train_loader, train_aug, isd, criterion, optimizer):
+    # only rank 0 logs and saves
+    is_main = args.rank == 0
 
-def train(args, train_loader, isd, criterion, optimizer):
     # visualization tool
-    writer = SummaryWriter(args.save_path + '/log')
+    writer = SummaryWriter(args.save_path + '/log') if is_main else None
 
     max_iterations = args.max_epoch * len(train_loader)
     iteration = 0
 
+    # dali batches are already on the gpu, otherwise overlap the h2d copy with compute
+    batches = train_loader if train_aug is None else CUDAPrefetcher(train_loader, to_gpu=(0,))
+
     # record the best(lowest) loss
     cur_best_loss = 10000
 
-    for ep in tqdm(range(args.start_epoch, args.max_epoch + 1)):
+    for ep in tqdm(range(args.start_epoch, args.max_epoch + 1), disable=not is_main):
 
         # train student
         isd.train()
-        total_train_loss = 0.0
-
-        for idx, data in tqdm(enumerate(train_loader)):
-            (im_q, im_k), _ = data
-            im_q, im_k = im_q.to(DEVICE), im_k.to(DEVICE)
+        loss_meter = AverageMeter()
+        batch_time = AverageMeter()
+        end = time.time()
+
+        # the cosine schedule only changes per epoch
+        cos_lr_ = args.learning_rate * 0.5 * (1. + math.cos(math.pi * (ep - 1) / args.max_epoch))
+
+        if args.distributed and train_aug is not None:
+            # reshuffle the DistributedSampler inside the BatchSampler
+            train_loader.sampler.sampler.set_epoch(ep)
+
+        for idx, data in tqdm(enumerate(batches), disable=not is_main):
+            if train_aug is None:
+                # dali already returns augmented crops on the gpu
+                im_q, im_k = data[0]['q'], data[0]['k']
+            else:
+                images, _ = data
+                im_q, im_k = train_aug(images)
+            im_q = im_q.contiguous(memory_format=torch.channels_last)
+            im_k = im_k.contiguous(memory_format=torch.channels_last)
 
             # ===================forward=====================
-            _, sim_q, sim_k = isd(im_q=im_q, im_k=im_k)
-            loss = criterion(inputs=sim_q, targets=sim_k)
+            # bf16 needs no GradScaler
+            with torch.autocast('cuda', dtype=torch.bfloat16, enabled=args.amp):
+                _, sim_q, sim_k, k = isd(im_q=im_q, im_k=im_k)
+                loss = criterion(inputs=sim_q, targets=sim_k)
 
             # ===================backward=====================
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
 
+            # the queue is saved for backward, so only update it now
+            isd.dequeue_and_enqueue(k)
+
             # ===================meters=====================
-            total_train_loss += loss.item()
+            # accumulated on the gpu, no loss.item() sync per step
+            loss_meter.update(loss.detach(), im_q.size(0))
+
+            # synchronize only every print_freq steps so timing does not drain the gpu each step
+            if (idx + 1) % args.print_freq == 0:
+                torch.cuda.synchronize()
+                batch_time.update((time.time() - end) / args.print_freq, args.print_freq)
+                end = time.time()
+                if is_main:
+                    writer.add_scalar('info/batch_time', batch_time.val, iteration)
+                    writer.add_scalar('info/isd_train_loss', loss.item(), iteration)
 
             ## adjust learning rate (cosine scheduler) if asjust_lr set to be True
             lr_ = args.learning_rate
@@ -241,24 +498,27 @@ def train(args, train_loader, isd, criterion, optimizer):
                 if args.adjust_lr:
                     lr_ = args.learning_rate * (1.0 - iteration / max_iterations) ** 0.9
                 else:
-                    lr_ = args.learning_rate * 0.5 * (1. + math.cos(math.pi * (ep - 1) / args.max_epoch))
+                    lr_ = cos_lr_
                 for param_group in optimizer.param_groups:
                     param_group['lr'] = lr_
 
 
-            writer.add_scalar('info/lr', lr_, iteration)
-            writer.add_scalar('info/isd_train_loss', loss, iteration)
+            if is_main:
+                writer.add_scalar('info/lr', lr_, iteration)
 
             iteration += 1
 
-        per_train_loss = total_train_loss / len(train_loader)
+        per_train_loss = loss_meter.avg
+
+        if not is_main:
+            continue
 
         if per_train_loss <= cur_best_loss:
             cur_best_loss = per_train_loss
             print('==> Saving...')
             state = {
                 'opt': args,
-                'state_dict': isd.state_dict(),
+                'state_dict': unwrap_state_dict(isd.state_dict()),
                 'optimizer': optimizer.state_dict(),
                 'epoch': ep,
             }
@@ -276,7 +536,7 @@ def train(args, train_loader, isd, criterion, optimizer):
             print('==> Saving...')
             state = {
                 'opt': args,
-                'state_dict': isd.state_dict(),
+                'state_dict': unwrap_state_dict(isd.state_dict()),
                 'optimizer': optimizer.state_dict(),
                 'epoch': ep,
             }
@@ -290,9 +550,11 @@ def train(args, train_loader, isd, criterion, optimizer):
 
         print(f'epoch: {ep:03}')
         print(f'\ttrain Loss: {per_train_loss:.3f}')
+        print(f'\tbatch time: {batch_time.avg:.3f}s')
 
-    print('training finished')
-    writer.close()
+    if is_main:
+        print('training finished')
+        writer.close()
 
 
 if __name__ == '__main__':
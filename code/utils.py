@@ -11,7 +11,6 @@ from __future__ import print_function
 import math
 
 import torch
-import numpy as np
 
 def count_parameters(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
@@ -24,6 +23,69 @@ def accuracy(outputs, labels):
     correct += (predicted == labels).sum().item()
     return correct/total
 
+class AverageMeter(object):
+    """computes and stores the average and current value
+
+    val may be a cuda tensor: the sum then stays on the gpu and is only
+    synchronized when avg is read
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.val = 0
+        self.sum = 0
+        self.count = 0
+
+    def update(self, val, n=1):
+        self.val = val
+        self.sum += val * n
+        self.count += n
+
+    @property
+    def avg(self):
+        if self.count == 0:
+            return 0
+        return float(self.sum / self.count)
+
+class CUDAPrefetcher:
+    """wraps a DataLoader and copies the next batch to the gpu on a side stream
+    while the current batch is being trained on; only the batch fields listed
+    in to_gpu are copied, the rest stay on the cpu (None copies all)"""
+    def __init__(self, loader, to_gpu=None):
+        self.loader = loader
+        self.to_gpu = to_gpu
+        self.stream = torch.cuda.Stream()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def preload(self, it):
+        try:
+            batch = next(it)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return [t.cuda(non_blocking=True) if self.to_gpu is None or i in self.to_gpu else t
+                    for i, t in enumerate(batch)]
+
+    def __iter__(self):
+        it = iter(self.loader)
+        batch = self.preload(it)
+        while batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            for t in batch:
+                if t.is_cuda:
+                    t.record_stream(torch.cuda.current_stream())
+            next_batch = self.preload(it)
+            yield batch
+            batch = next_batch
+
+def unwrap_state_dict(state_dict):
+    """drop the '_orig_mod.' and 'module.' prefixes torch.compile and
+    DistributedDataParallel add to wrapped submodules"""
+    return {k.replace('._orig_mod.', '.').replace('.module.', '.'): v for k, v in state_dict.items()}
+
 class TwoCropsTransform:
     def __init__(self, k_t, q_t):
         self.q_t = q_t